@@ -1,8 +1,9 @@
 import asyncio
 import os
 import uuid
-import json
+import orjson
 import redis.asyncio as redis
+from redis.exceptions import RedisError
 import logging
 
 from sanic import Sanic, html
@@ -30,12 +31,68 @@ app.static('/', './index.html', name="index")
 logging.basicConfig(filename='perso.log', encoding='utf-8', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Redis client for pub/sub
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+@app.before_server_start
+async def setup_redis(app):
+    # Redis client for pub/sub, one per worker process
+    app.ctx.redis = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+
+@app.before_server_start
+async def setup_pubsub(app):
+    # One subscriber per process; SSE connections register a queue per user
+    app.ctx.user_queues = {}
+    # Named so Sanic cancels it on shutdown, before close_db closes the pool
+    app.add_task(dispatch_updates(app), name="dispatch_updates")
+
+# Progress updates a slow SSE connection may have pending before new ones are dropped;
+# done updates (complete/error) are always delivered
+PROGRESS_BACKLOG = 8
+
+def route_update(app, message):
+    # channel is user:{user_id}:{progress|done}
+    user_id, kind = message['channel'].removeprefix('user:').rsplit(':', 1)
+    queues = app.ctx.user_queues.get(user_id)
+    if not queues:
+        return
+    data = orjson.loads(message['data'])
+    for queue in queues:
+        if kind == 'progress' and queue.qsize() >= PROGRESS_BACKLOG:
+            continue
+        queue.put_nowait(data)
+
+async def dispatch_updates(app):
+    # Every /status_updates on this worker waits on this task, so it must outlive
+    # bad messages and dropped connections
+    retry_delay = 0
+    while True:
+        pubsub = app.ctx.redis.pubsub()
+        try:
+            await pubsub.psubscribe("user:*")
+            if retry_delay:
+                logger.info("redis pub/sub reconnected")
+                retry_delay = 0
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message['type'] != 'pmessage':
+                    continue
+                try:
+                    route_update(app, message)
+                except Exception:
+                    logger.exception(f"dropping update on {message.get('channel')}")
+        except RedisError as e:
+            # Full traceback once per outage, then a short warning per retry with backoff
+            if not retry_delay:
+                logger.exception("redis pub/sub connection lost, resubscribing")
+                retry_delay = 1
+            else:
+                logger.warning(f"redis pub/sub still unavailable ({e}), retrying in {retry_delay}s")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+        finally:
+            await pubsub.aclose()
 
 @app.after_server_stop
 async def close_db(app):
-    await redis_client.aclose()
+    await app.ctx.redis.aclose()
 
 @app.on_response
 async def cookie(request, response):
@@ -45,6 +102,12 @@ async def cookie(request, response):
 
 # ROUTES
 
+# Constant SSE event, formatted once at import
+DONE_EVENT = SSE.patch_elements("<div id='status'><progress value='100' max='100'></progress><div><strong>Done:</strong> Processing complete! Redirecting...</div></div>")
+
+# Gallery entries by video id, as (frames.json mtime, html fragment)
+_GALLERY_CACHE: dict[str, tuple[float, str]] = {}
+
 @app.get("/status_updates")
 @datastar_response
 async def status_updates(request):
@@ -54,10 +117,17 @@ async def status_updates(request):
         try:
             vid_id = vid_dir.name
             frames_json = vid_dir / 'frames.json'
-            data = json.loads(frames_json.read_text())
+            mtime = frames_json.stat().st_mtime
+            cached = _GALLERY_CACHE.get(vid_id)
+            if cached and cached[0] == mtime:
+                items.append(cached[1])
+                continue
+            data = orjson.loads(frames_json.read_bytes())
             name = data['db_details']['1']['name']
             thumb_path = f"/videos/{vid_id}/frame_00.jpg"
-            items.append(f"<a href='/v/{vid_id}' class='gc'><img src='{thumb_path}' alt='{name}'><span>{name}</span></a>")
+            item = f"<a href='/v/{vid_id}' class='gc'><img src='{thumb_path}' alt='{name}'><span>{name}</span></a>"
+            _GALLERY_CACHE[vid_id] = (mtime, item)
+            items.append(item)
         except Exception:
             pass
     gallery_html = f"""
@@ -68,31 +138,33 @@ async def status_updates(request):
     yield SSE.patch_elements(gallery_html)
 
     user_id = request.cookies.get('user_id')
-    pubsub = redis_client.pubsub()
-    await pubsub.subscribe(f"user:{user_id}")
+    queue = asyncio.Queue()
+    app.ctx.user_queues.setdefault(user_id, set()).add(queue)
 
     video_url = None
     try:
-        async for message in pubsub.listen():
-            if message['type'] == 'message':
-                data = json.loads(message['data'])
-                if data.get('status') == "complete":
-                    video_url = data.get('video_url')
-                    yield SSE.patch_elements("<div id='status'><progress value='100' max='100'></progress><div><strong>Done:</strong> Processing complete! Redirecting...</div></div>")
-                    break
-                else:
-                    progress = data.get('progress')
-                    progress_html = f"<progress value='{progress}' max='100'></progress>" if progress is not None else ""
-                    status_html = f"""
-                    <div id="status">
-                        {progress_html}
-                        <div><strong>{data.get('status')}:</strong> {data.get('message')}</div>
-                    </div>
-                    """
-                    yield SSE.patch_elements(status_html)
+        while True:
+            data = await queue.get()
+            if data.get('status') == "complete":
+                video_url = data.get('video_url')
+                yield DONE_EVENT
+                break
+            else:
+                progress = data.get('progress')
+                progress_html = f"<progress value='{progress}' max='100'></progress>" if progress is not None else ""
+                status_html = f"""
+                <div id="status">
+                    {progress_html}
+                    <div><strong>{data.get('status')}:</strong> {data.get('message')}</div>
+                </div>
+                """
+                yield SSE.patch_elements(status_html)
     finally:
-        await pubsub.unsubscribe(f"user:{user_id}")
-        await pubsub.aclose()
+        queues = app.ctx.user_queues.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del app.ctx.user_queues[user_id]
         yield SSE.redirect(video_url or "/")
     
 
@@ -104,7 +176,7 @@ async def process(request):
     quality = data.get('quality', '360p')
     user_id = request.cookies.get('user_id')
 
-    asyncio.create_task(process_video(video_url, user_id, quality))
+    asyncio.create_task(process_video(video_url, request.app.ctx.redis, user_id, quality))
 
     return SSE.patch_elements('<div id="form">yes chief, one moment</div>')
 
@@ -124,8 +196,10 @@ async def video_page(request, id):
 
 
 if __name__ == "__main__":
+    # Sanic picks up uvloop on its own when it is installed
     app.run(
     debug=False,
-    auto_reload=True,
+    auto_reload=False,
+    workers=os.cpu_count() or 1,
     unix='soy.sock',
     access_log=False)
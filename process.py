@@ -1,14 +1,13 @@
 import os
+import time
 import uuid
 import subprocess
 from pathlib import Path
 import asyncio
 import numpy as np
-from PIL import Image
-from scipy.cluster.vq import kmeans, vq
-from tinydb import TinyDB
-import json
-import redis.asyncio as redis
+from numba import njit
+import aiofiles
+import orjson
 import logging
 import colorsys
 
@@ -23,7 +22,8 @@ if os.name == 'nt':
         pass
 
 
-async def _run_subprocess(cmd):
+async def _run_subprocess(cmd, text=True):
+    # text=False leaves stdout as bytes, e.g. for orjson to parse directly
     try:
         process = await asyncio.create_subprocess_exec(
             *cmd,
@@ -31,18 +31,16 @@ async def _run_subprocess(cmd):
             stderr=asyncio.subprocess.PIPE,
         )
         stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, cmd, stdout.decode(), stderr.decode())
-        return subprocess.CompletedProcess(cmd, process.returncode, stdout.decode(), stderr.decode())
+        returncode = process.returncode
     except NotImplementedError:
         # Fallback for environments/loops that don't support asyncio subprocess (e.g., some Windows loops)
-        def _run_blocking():
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
-            return result
-        result = await asyncio.to_thread(_run_blocking)
-        return subprocess.CompletedProcess(cmd, result.returncode, result.stdout, result.stderr)
+        result = await asyncio.to_thread(subprocess.run, cmd, capture_output=True)
+        stdout, stderr, returncode = result.stdout, result.stderr, result.returncode
+    if text:
+        stdout = stdout.decode()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr.decode())
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr.decode())
 
 async def get_video_info(url):
     cmd = [
@@ -52,8 +50,8 @@ async def get_video_info(url):
         '--skip-download',
         url
     ]
-    result = await _run_subprocess(cmd)
-    data = json.loads(result.stdout)
+    result = await _run_subprocess(cmd, text=False)
+    data = orjson.loads(result.stdout)
 
     duration = int(data.get('duration', 0))
     title = data.get('title', '')[:15]
@@ -76,49 +74,184 @@ async def download_video(url, output_path, quality="360p"):
     ]
     await _run_subprocess(cmd)
 
-async def extract_frames(video_path, folder_path, interval=3, scale_width=320):
+async def extract_frames(video_path, folder_path, interval=3, scale_width=320, palette_size=32):
+    # Writes JPEG thumbnails to folder_path and yields (frame_name, pixels) per frame,
+    # pixels being a (palette_size**2, 3) uint8 tile read straight from ffmpeg's stdout
     output_pattern = folder_path / 'frame_%02d.jpg'
     vf = f"fps=1/{interval},scale={scale_width}:-1"
+    # Second output: a tiny area-averaged RGB tile per frame, used for color analysis
+    palette_vf = f"fps=1/{interval},scale={palette_size}:{palette_size}:flags=area"
     cmd = [
         'ffmpeg',
+        '-y',  # Overwrite output files
         '-i', str(video_path),
         '-vf', vf,
         '-q:v', '8',  # JPEG quality (2-31; higher is worse). 8 is compact yet visually ok
         '-start_number', '0',
         str(output_pattern),
-        '-y'  # Overwrite output files
+        '-vf', palette_vf,
+        '-pix_fmt', 'rgb24',
+        '-f', 'rawvideo',
+        'pipe:1',
     ]
-    await _run_subprocess(cmd)
+    frame_size = palette_size * palette_size * 3
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except NotImplementedError:
+        # Same fallback as _run_subprocess: run ffmpeg to completion in a thread,
+        # then slice its buffered stdout into tiles (no overlap with analysis)
+        result = await asyncio.to_thread(subprocess.run, cmd, capture_output=True)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cmd, None, result.stderr.decode())
+        for index in range(len(result.stdout) // frame_size):
+            buf = result.stdout[index * frame_size:(index + 1) * frame_size]
+            yield f"frame_{index:02d}.jpg", np.frombuffer(buf, dtype=np.uint8).reshape(-1, 3)
+        return
 
-async def analyze_frame_colors(image_path, k=2):
-    def _work():
-        img = Image.open(image_path).convert('RGB')
-        pixels = np.array(img)
-        h, w, c = pixels.shape
+    # Drain stderr concurrently so ffmpeg never blocks on a full pipe
+    stderr_task = asyncio.create_task(process.stderr.read())
+    index = 0
+    try:
+        while True:
+            try:
+                buf = await process.stdout.readexactly(frame_size)
+            except asyncio.IncompleteReadError:
+                break
+            yield f"frame_{index:02d}.jpg", np.frombuffer(buf, dtype=np.uint8).reshape(-1, 3)
+            index += 1
+    finally:
+        if process.returncode is None and not process.stdout.at_eof():
+            process.kill()
+        stderr = await stderr_task
+        returncode = await process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, None, stderr.decode())
 
-        pixels_reshaped = pixels.reshape((h * w, c))
-        pixels_float = pixels_reshaped.astype(float)
-        
-        centroids, _ = kmeans(pixels_float, k)
-        labels, _ = vq(pixels_float, centroids)
-        unique, counts = np.unique(labels, return_counts=True)
-        total_pixels = h * w
-        
-        results_local = []
-        for i, centroid in enumerate(centroids):
-            results_local.append({
-                'color_rgb': [int(c) for c in centroid],
-                'percentage': round(counts[i] / total_pixels * 100) if i < len(counts) else 0.0
-            })
-        return results_local
+@njit(cache=True, fastmath=True, nogil=True)
+def _km2_rgb(pixels, iters):
+    # 2-means specialized for RGB: assignment is the side of the plane bisecting c0 and c1
+    n = pixels.shape[0]
+    # Seeded from pixel 0, not +/-inf: fastmath assumes no infinities
+    lo = 0
+    hi = 0
+    lo_luma = 0.299 * pixels[0, 0] + 0.587 * pixels[0, 1] + 0.114 * pixels[0, 2]
+    hi_luma = lo_luma
+    for i in range(1, n):
+        luma = 0.299 * pixels[i, 0] + 0.587 * pixels[i, 1] + 0.114 * pixels[i, 2]
+        if luma < lo_luma:
+            lo_luma = luma
+            lo = i
+        if luma > hi_luma:
+            hi_luma = luma
+            hi = i
+    c0 = pixels[lo].astype(np.float32)
+    c1 = pixels[hi].astype(np.float32)
+    s0 = np.empty(3, dtype=np.float32)
+    s1 = np.empty(3, dtype=np.float32)
+    n0 = 0
+    n1 = 0
+    # iters updates, plus a last pass that only counts against the final centroids
+    for it in range(iters + 1):
+        w = c1 - c0
+        b = np.float32(0.5) * ((c1 * c1).sum() - (c0 * c0).sum())
+        s0[:] = 0.0
+        s1[:] = 0.0
+        n0 = 0
+        n1 = 0
+        for i in range(n):
+            r = np.float32(pixels[i, 0])
+            g = np.float32(pixels[i, 1])
+            bl = np.float32(pixels[i, 2])
+            if r * w[0] + g * w[1] + bl * w[2] > b:
+                s1[0] += r
+                s1[1] += g
+                s1[2] += bl
+                n1 += 1
+            else:
+                s0[0] += r
+                s0[1] += g
+                s0[2] += bl
+                n0 += 1
+        if it == iters:
+            break
+        if n0 > 0:
+            c0 = s0 / np.float32(n0)
+        if n1 > 0:
+            c1 = s1 / np.float32(n1)
+    return c0, c1, n0, n1
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _km2_rgb_batch(batch, iters):
+    # batch is (frames, pixels, 3); one compiled call for every frame
+    n = batch.shape[0]
+    centroids = np.empty((n, 2, 3), dtype=np.float32)
+    counts = np.empty((n, 2), dtype=np.int64)
+    for f in range(n):
+        c0, c1, n0, n1 = _km2_rgb(batch[f], iters)
+        centroids[f, 0] = c0
+        centroids[f, 1] = c1
+        counts[f, 0] = n0
+        counts[f, 1] = n1
+    return centroids, counts
+
+async def analyze_frames_colors(batch, iters=8):
+    # 2-means over a stack of same-sized tiles, in a single thread hop
+    def _work():
+        centroids, counts = _km2_rgb_batch(batch, iters)
+        total_pixels = batch.shape[1]
+        return [
+            [
+                {'color_rgb': [int(c) for c in centroid], 'percentage': round(count / total_pixels * 100)}
+                for centroid, count in zip(frame_centroids, frame_counts)
+            ]
+            for frame_centroids, frame_counts in zip(centroids, counts)
+        ]
 
     return await asyncio.to_thread(_work)
 
+PAGE_HEAD = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>SOY</title>
+    <link rel="icon" href="/static/img/rocket.png">
+    <link rel="stylesheet" href="/static/css/site.css">
+    <script type="module" src="/static/js/datastar.js"></script>
+</head>
+<body class="gc">
+'''
+
+PAGE_TAIL = '''
+        </div>
+    </article>
+</body>
+</html>
+'''
+
+FRAME_OPEN = '''
+<div>
+    '''
+
+FRAME_CLOSE = '''
+</div>
+'''
+
 async def build_page(folder_path, video_url, details, frames):  
 
     def rgb_style(rgb):
         return f"background-color: rgb({rgb[0]}, {rgb[1]}, {rgb[2]})"
 
+    def rgb_to_hsl(rgb):
+        r, g, b = [x / 255.0 for x in rgb]
+        h, l, s = colorsys.rgb_to_hls(r, g, b)
+        return (h, s, l)
+
     name = details[0].get('name') if details else 'Video ?!'
     url = details[0].get('url') if details else video_url
 
@@ -128,52 +261,30 @@ async def build_page(folder_path, video_url, details, frames):
         frame_file_name = frame.get('frame_name', "no name ?!")
         img_src = f"/videos/{folder_path.name}/{frame_file_name}"
         
-        color_bars = ""
-        
-        def rgb_to_hsl(rgb):
-            r, g, b = [x / 255.0 for x in rgb]
-            h, l, s = colorsys.rgb_to_hls(r, g, b)
-            return (h, s, l)
-
-        sorted_clusters = sorted(clusters, key=lambda cluster: cluster.get('percentage', 0))
+        color_bars = []
         sorted_clusters = sorted(clusters, key=lambda cluster: rgb_to_hsl(cluster.get('color_rgb', [0, 0, 0])))
 
         for cluster in sorted_clusters:
             color = cluster.get('color_rgb', [0, 0, 0])
             percent = cluster.get('percentage', 0)
-            color_bars += f'<div style="{rgb_style(color)}; height: {percent}%"></div>\n'
-        frames_list.append(
-            f'''
-<div>
-    {color_bars}<img src="{img_src}"></img>
-</div>
-'''
-        )
+            color_bars.append(f'<div style="{rgb_style(color)}; height: {percent}%"></div>\n')
+        frames_list.append(FRAME_OPEN)
+        frames_list.extend(color_bars)
+        frames_list.append(f'<img src="{img_src}"></img>{FRAME_CLOSE}')
     
-    frames_count = len(frames_list)
+    frames_count = len(frames)
     columns = frames_count if frames_count > 0 else 1
 
-    HTML = f'''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>SOY</title>
-    <link rel="icon" href="/static/img/rocket.png">
-    <link rel="stylesheet" href="/static/css/site.css">
-    <script type="module" src="/static/js/datastar.js"></script>
-</head>
-<body class="gc">
-    <h1 class="gt-xl gm-xl"><a href="{url}">{name}</a></h1>
+    parts = [
+        PAGE_HEAD,
+        f'''    <h1 class="gt-xl gm-xl"><a href="{url}">{name}</a></h1>
     <article class="gc">
         <div class="frames" style="grid-template-columns: repeat({columns}, 1fr)">
-            {"".join(frames_list)}
-        </div>
-    </article>
-</body>
-</html>
-'''
+''',
+    ]
+    parts.extend(frames_list)
+    parts.append(PAGE_TAIL)
+    HTML = "".join(parts)
     try:
         tmp_path = folder_path / 'video.html.tmp'
         final_path = folder_path / 'video.html'
@@ -182,7 +293,19 @@ async def build_page(folder_path, video_url, details, frames):
     except Exception as e:
         raise
 
-async def process_video(video_url, user_id=None, quality="360p"):
+async def write_frames_json(folder_path, details, frames):
+    # Same layout TinyDB used to write: tables of documents keyed by 1-based id
+    data = {
+        'db_details': {str(i): d for i, d in enumerate(details, start=1)},
+        'frames': {str(i): f for i, f in enumerate(frames, start=1)},
+    }
+    tmp_path = folder_path / 'frames.json.tmp'
+    final_path = folder_path / 'frames.json'
+    async with aiofiles.open(tmp_path, 'wb') as f:
+        await f.write(orjson.dumps(data))
+    os.replace(tmp_path, final_path)
+
+async def process_video(video_url, redis_client, user_id=None, quality="360p"):
     logger.info(f"user {user_id} requested {video_url}")
     folder_id = str(uuid.uuid4())
     videos_root = Path("videos")
@@ -190,12 +313,10 @@ async def process_video(video_url, user_id=None, quality="360p"):
     folder_path = videos_root / folder_id
     folder_path.mkdir(exist_ok=True)
     
-    # Redis client for pub/sub updates (async)
-    redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
-    
     async def publish_update(message):
         if user_id:
-            await redis_client.publish(f"user:{user_id}", json.dumps(message))
+            kind = "done" if message.get("status") in ("complete", "error") else "progress"
+            await redis_client.publish(f"user:{user_id}:{kind}", orjson.dumps(message))
     
     try:
         await publish_update({"status": "fetching_metadata", "message": "Getting video info...", "progress": 5})
@@ -213,45 +334,74 @@ async def process_video(video_url, user_id=None, quality="360p"):
         if not video_path.exists() or video_path.stat().st_size == 0:
             raise ValueError("Video download did not produce a valid file") 
         
-        await publish_update({"status": "extracting_frames", "message": "Extracting frames...", "progress": 35})
-        await extract_frames(video_path, folder_path, interval=3)
-        
-        db_path = folder_path / 'frames.json'
-        db = TinyDB(db_path, sort_keys=True, indent=4)
-        db_frames = db.table("frames")
-        db_details = db.table("db_details")
-
-        await asyncio.to_thread(db_details.insert, {
+        details = [{
             'name': title,
             'url': canonical_url,
             'length_seconds': duration,
-        })
-        
-        frame_files = sorted(folder_path.glob('frame_*.jpg'))
-        
-        if len(frame_files) == 0:
+        }]
+
+        await publish_update({"status": "extracting_frames", "message": "Extracting and analyzing frames...", "progress": 35})
+        interval = 3
+        expected_frames = max(1, duration // interval)
+        queue = asyncio.Queue()
+        entries = []
+        last_pub = 0.0
+
+        # One consumer analyzes frames while ffmpeg is still producing the next ones.
+        # A job is at most 20 tiny tiles, so more consumers would only split its batches.
+        async def analyze_worker():
+            nonlocal last_pub
+            while True:
+                # Take every frame already waiting, up to the sentinel, as one batch
+                item = await queue.get()
+                batch = []
+                while item is not None:
+                    batch.append(item)
+                    if queue.empty():
+                        break
+                    item = queue.get_nowait()
+
+                if batch:
+                    frame_names, tiles = zip(*batch)
+                    analyses = await analyze_frames_colors(np.stack(tiles))
+                    entries.extend(
+                        {'frame_name': frame_name, 'analysis': analysis}
+                        for frame_name, analysis in zip(frame_names, analyses)
+                    )
+
+                    # Throttle progress: the SSE client only renders the latest state
+                    now = time.monotonic()
+                    if now - last_pub > 0.25:
+                        last_pub = now
+                        analyze_progress = 40 + int(50 * (len(entries) / expected_frames))
+                        await publish_update({
+                            "status": "analyzing",
+                            "message": f"Analyzed {len(entries)} frames...",
+                            "progress": min(analyze_progress, 90)
+                        })
+
+                if item is None:
+                    return
+
+        worker = asyncio.create_task(analyze_worker())
+        try:
+            async for frame in extract_frames(video_path, folder_path, interval=interval):
+                queue.put_nowait(frame)
+        finally:
+            queue.put_nowait(None)
+            await worker
+
+        if len(entries) == 0:
             raise ValueError("No frames were extracted from the video") 
 
-        await publish_update({"status": "analyzing", "message": f"Analyzing {len(frame_files)} frames...", "progress": 40})
-        total_frames = len(frame_files)
-        for index, frame_path in enumerate(frame_files, start=1):
-            frame_name = frame_path.name
-            analysis = await analyze_frame_colors(frame_path, k=2)
-            entry = {
-                'frame_name': frame_name,
-                'analysis': analysis
-            }
-            await asyncio.to_thread(db_frames.insert, entry)
-
-            analyze_progress = 50 + int(40 * (index / total_frames))
-            await publish_update({
-                "status": "analyzing",
-                "message": f"Analyzed {index}/{total_frames} frames...",
-                "progress": min(analyze_progress, 90)
-            })
-
-        details = db_details.all()
-        frames = sorted(db_frames.all(), key=lambda f: f.get('frame_name', ''))
+        await publish_update({
+            "status": "analyzing",
+            "message": f"Analyzed {len(entries)}/{len(entries)} frames...",
+            "progress": 90
+        })
+
+        frames = sorted(entries, key=lambda f: f.get('frame_name', ''))
+        await write_frames_json(folder_path, details, frames)
         await publish_update({"status": "building_page", "message": "Generating HTML page...", "progress": 95})
         await build_page(folder_path, video_url, details, frames)
 